@@ -2,16 +2,27 @@ import os
 import time
 import json
 import logging
+import threading
+import queue
+import functools
+import re
+from concurrent.futures import ThreadPoolExecutor
 import schedule
 import tweepy
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import hashlib
 import hmac
 import base64
 from datetime import datetime
 import urllib.parse
 from dotenv import load_dotenv
-import re
+
+try:
+    import orjson  # JSONの読み書きを高速化（未インストールなら標準のjsonを使用）
+except ImportError:
+    orjson = None
 
 # 環境変数の読み込み
 load_dotenv()
@@ -33,6 +44,30 @@ PA_API_SECRET = os.getenv("PA_API_SECRET")
 PARTNER_TAG = os.getenv("PARTNER_TAG")
 MARKETPLACE = "www.amazon.co.jp"
 REGION = "us-west-2"  # PA-APIのリージョン
+PA_API_SERVICE = "ProductAdvertisingAPI"
+# 署名キー導出で日付の後に順に適用する値（事前にエンコードしておく）
+SIGNING_KEY_SCOPE = (REGION.encode('utf-8'), PA_API_SERVICE.encode('utf-8'), b'aws4_request')
+PA_API_TARGET = "com.amazon.paapi5.v1.ProductAdvertisingAPIv1.GetItems"
+# GetItemsリクエストの固定部分（ItemIdsのみリクエストごとに変わる）
+PA_API_PAYLOAD_TEMPLATE = {
+    "Resources": [
+        "ItemInfo.Title",
+        "Offers.Listings.Price",
+        "Offers.Listings.Availability.Message"
+    ],
+    "PartnerTag": PARTNER_TAG,
+    "PartnerType": "Associates",
+    "Marketplace": MARKETPLACE
+}
+# 署名対象ヘッダー（名前順）。リクエストごとに変わるのはhostとx-amz-dateのみ
+SIGNED_HEADERS = "content-encoding;content-type;host;x-amz-date;x-amz-target"
+CANONICAL_HEADERS_TEMPLATE = (
+    "content-encoding:amz-1.0\n"
+    "content-type:application/json; charset=utf-8\n"
+    "host:{host}\n"
+    "x-amz-date:{amz_date}\n"
+    f"x-amz-target:{PA_API_TARGET}\n"
+)
 
 # X API設定
 CONSUMER_KEY = os.getenv("TWITTER_CONSUMER_KEY")
@@ -43,30 +78,209 @@ ACCESS_TOKEN_SECRET = os.getenv("TWITTER_ACCESS_TOKEN_SECRET")
 # トラッキング設定
 TRACKING_PRODUCTS_FILE = "tracking_products.json"
 TEMPLATES_FILE = "post_templates.json"
+PRICE_HISTORY_FILE = "price_history.jsonl"  # 価格履歴（1行1レコードの追記専用ログ）
+
+# 並行処理設定
+PA_API_TPS = 1  # PA-APIの1秒あたりのリクエスト上限
+PA_API_BURST = 1  # PA-APIの連続リクエスト数の上限
+PA_API_MIN_TPS = 1 / 30  # スロットリング時に下げる発行ペースの下限
+PA_API_TPS_STEP = 0.1  # 成功時に発行ペースを戻す幅
+PA_API_MAX_RETRIES = 3  # スロットリング（429/503）時の再試行回数
+PA_API_MAX_WORKERS = 4  # PA-APIの同時リクエスト数
+PA_API_TIMEOUT = (5, 15)  # PA-APIの（接続, 読み込み）タイムアウト秒数
+TWITTER_POSTS_PER_WINDOW = 300  # X投稿のレート制限（時間枠あたりの投稿数）
+TWITTER_RATE_WINDOW = 3 * 60 * 60  # X投稿のレート制限の時間枠（秒）
+STABLE_PRODUCT_RECHECK_SECONDS = 60 * 60  # 変動のなかった商品を再チェックするまでの最短間隔（秒）
+TWEET_MAX_LENGTH = 280  # X投稿の最大文字数（重み付き）
+TWEET_URL_LENGTH = 23  # XではURLは長さに関わらず23文字として数えられる
+SCHEDULING_RESOLUTION = 60  # スケジューラが次回実行時刻を再計算する最大間隔（秒）
+
+
+_URL_RE = re.compile(r'https?://\S+')
+
+
+def tweet_char_weight(ch):
+    """X投稿での文字の重み（ラテン文字や一部の記号は1、日本語などそれ以外の文字は2）"""
+    cp = ord(ch)
+    if cp <= 0x10FF or 0x2000 <= cp <= 0x200D or 0x2010 <= cp <= 0x201F or 0x2032 <= cp <= 0x2037:
+        return 1
+    return 2
+
+
+def tweet_length(text):
+    """X投稿の重み付き文字数（URLは23文字、日本語などは1文字を2として数える）"""
+    url_count = len(_URL_RE.findall(text))
+    return sum(map(tweet_char_weight, _URL_RE.sub("", text))) + TWEET_URL_LENGTH * url_count
+
+
+def truncate_tweet_text(text, limit):
+    """重み付き文字数がlimit以下になるよう先頭から切り出す"""
+    total = 0
+    for i, ch in enumerate(text):
+        total += tweet_char_weight(ch)
+        if total > limit:
+            return text[:i]
+    return text
+
+
+_amz_date_cache = (None, "")  # (UNIX時刻の秒, x-amz-date形式の文字列)
+
+
+def amz_date_now():
+    """現在時刻をx-amz-date形式（UTC）で取得（同じ秒の間は整形結果を再利用）"""
+    global _amz_date_cache
+    sec = int(time.time())
+    cached_sec, amz_date = _amz_date_cache
+    if sec != cached_sec:
+        amz_date = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(sec))
+        # 複数スレッドから参照されるため、タプルごと置き換える
+        _amz_date_cache = (sec, amz_date)
+    return amz_date
+
+
+def json_loads(data):
+    """JSONバイト列を読み込む（orjsonがあれば使用）"""
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj, indent=True):
+    """JSONバイト列に変換する（orjsonがあれば使用）"""
+    if orjson:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2 if indent else None)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode('utf-8')
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def parse_retry_after(response):
+    """Retry-Afterヘッダーの待機秒数を取得（無い場合や日時形式の場合は0）"""
+    try:
+        return max(0.0, float(response.headers.get("Retry-After", 0)))
+    except ValueError:
+        return 0.0
+
+
+def file_mtime(path):
+    """ファイルの更新時刻を取得（存在しない場合はNone）"""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def write_file_atomic(path, data):
+    """一時ファイルに書き込んでから置き換える（書き込み中に中断されてもファイルを壊さない）"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class TokenBucket:
+    """トークンバケット方式のレートリミッター（スレッドセーフ）"""
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate  # 1秒あたりに補充されるトークン数
+        self.capacity = capacity  # 連続して発行できる最大数
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """トークンを1つ取得（不足している場合は補充されるまで待機）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # 不足分は先取りし、補充されるまでの時間だけ待つ（後続の呼び出しはさらに後ろに並ぶ）
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def set_rate(self, rate):
+        """補充ペースを変更（変更前のペースで補充済みのトークンは維持）"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate
 
 
 class AmazonTracker:
     def __init__(self):
+        self.pa_api_limiter = TokenBucket(PA_API_TPS, PA_API_BURST)
+        self._signing_key_cache = {}  # 日付 -> 署名キー（署名キーは日付単位でしか変わらない）
+        self.setup_http_session()
+        self._products_mtime = file_mtime(TRACKING_PRODUCTS_FILE)
         self.products = self.load_products()
+        self._by_asin = {product["asin"]: product for product in self.products}
+        self._next_check = {}  # ASIN -> 次にチェックするtime.monotonic()の時刻
+        self.migrate_price_history()
         self.templates = self.load_templates()
-        self.setup_twitter_api()
-        
-    def setup_twitter_api(self):
-        """Twitter APIの設定"""
+        self._templates_mtime = file_mtime(TEMPLATES_FILE)
+        self.setup_tweet_worker()
+        
+    def setup_tweet_worker(self):
+        """X投稿をバックグラウンドで処理するワーカーを起動（商品チェックを投稿待ちで止めない）"""
+        self.tweet_limiter = TokenBucket(TWITTER_POSTS_PER_WINDOW / TWITTER_RATE_WINDOW, TWITTER_POSTS_PER_WINDOW)
+        self._tweet_queue = queue.Queue()
+        threading.Thread(target=self.tweet_worker, daemon=True).start()
+    
+    def tweet_worker(self):
+        """キューに積まれた投稿を順に処理"""
+        while True:
+            product, changes = self._tweet_queue.get()
+            try:
+                self.tweet_limiter.acquire()
+                self.send_tweet(product, changes)
+            finally:
+                self._tweet_queue.task_done()
+    
+    def wait_for_tweets(self):
+        """キューに積まれた投稿がすべて完了するまで待機"""
+        self._tweet_queue.join()
+    
+    def setup_http_session(self):
+        """PA-API用のHTTPセッションを設定（接続を再利用してTLSハンドシェイクを削減）"""
+        self.http = requests.Session()
+        # GetItemsは参照系のため、一時的なサーバーエラーはPOSTでも再試行する
+        retry = Retry(
+            total=3,
+            backoff_factor=0.5,
+            status_forcelist=[500, 502, 504],  # 429/503はcall_pa_apiで発行ペースを調整して再試行
+            allowed_methods=["POST"],
+            # 429/503はRetry-After付きだとstatus_forcelist外でも再試行されるため、urllib3側では扱わない
+            respect_retry_after_header=False
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=PA_API_MAX_WORKERS, max_retries=retry)
+        self.http.mount("https://", adapter)
+    
+    @functools.cached_property
+    def twitter_api(self):
+        """Twitter APIクライアント（投稿しないコマンドでは生成しないよう初回アクセス時に設定）"""
         try:
-            auth = tweepy.OAuthHandler(CONSUMER_KEY, CONSUMER_SECRET)
-            auth.set_access_token(ACCESS_TOKEN, ACCESS_TOKEN_SECRET)
-            self.twitter_api = tweepy.API(auth)
+            # v1.1のupdate_statusは廃止されたため、v2のClient（create_tweet）を使用
+            client = tweepy.Client(
+                consumer_key=CONSUMER_KEY,
+                consumer_secret=CONSUMER_SECRET,
+                access_token=ACCESS_TOKEN,
+                access_token_secret=ACCESS_TOKEN_SECRET
+            )
             logger.info("Twitter API認証成功")
+            return client
         except Exception as e:
             logger.error(f"Twitter API認証エラー: {e}")
-            self.twitter_api = None
+            return None
     
     def load_products(self):
         """追跡商品リストを読み込む"""
         try:
-            with open(TRACKING_PRODUCTS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return self.read_products()
         except FileNotFoundError:
             logger.info(f"{TRACKING_PRODUCTS_FILE}が見つかりません。新規作成します。")
             return []
@@ -74,11 +288,25 @@ class AmazonTracker:
             logger.error(f"{TRACKING_PRODUCTS_FILE}の解析に失敗しました。")
             return []
     
+    def read_products(self):
+        """追跡商品リストをファイルから読み込む（ファイルが無い・解析できない場合は例外を送出）"""
+        with open(TRACKING_PRODUCTS_FILE, 'rb') as f:
+            products = json_loads(f.read())
+        
+        # 重複したASINは最初のものだけを残す
+        unique_products = {}
+        for product in products:
+            if product["asin"] in unique_products:
+                logger.warning(f"重複したASINを除外しました: {product['asin']}")
+                continue
+            unique_products[product["asin"]] = product
+        return list(unique_products.values())
+    
     def load_templates(self):
         """投稿テンプレートを読み込む"""
         try:
-            with open(TEMPLATES_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(TEMPLATES_FILE, 'rb') as f:
+                return json_loads(f.read())
         except FileNotFoundError:
             logger.info(f"{TEMPLATES_FILE}が見つかりません。デフォルトテンプレートを使用します。")
             # デフォルトテンプレートを作成
@@ -101,22 +329,63 @@ class AmazonTracker:
                 }
             }
             # テンプレートを保存
-            with open(TEMPLATES_FILE, 'w', encoding='utf-8') as f:
-                json.dump(default_templates, f, ensure_ascii=False, indent=2)
+            write_file_atomic(TEMPLATES_FILE, json_dumps(default_templates))
             return default_templates
     
     def save_products(self):
         """追跡商品リストを保存する"""
-        with open(TRACKING_PRODUCTS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.products, f, ensure_ascii=False, indent=2)
+        write_file_atomic(TRACKING_PRODUCTS_FILE, json_dumps(self.products))
+        self._products_mtime = file_mtime(TRACKING_PRODUCTS_FILE)
         logger.info("商品リストを保存しました")
     
+    def append_price_history(self, entries):
+        """価格履歴を追記する（既存の履歴は書き換えない）"""
+        if not entries:
+            return
+        with open(PRICE_HISTORY_FILE, 'ab') as f:
+            f.writelines(json_dumps(entry, indent=False) + b"\n" for entry in entries)
+    
+    def migrate_price_history(self):
+        """商品リストに埋め込まれた旧形式の価格履歴を履歴ファイルへ移行"""
+        entries = []
+        for product in self.products:
+            for record in product.pop("price_history", None) or []:
+                entries.append({"asin": product["asin"], **record})
+        
+        if entries:
+            self.append_price_history(entries)
+            self.save_products()
+            logger.info(f"価格履歴を{PRICE_HISTORY_FILE}に移行しました（{len(entries)}件）")
+    
     def save_templates(self):
         """テンプレートを保存する"""
-        with open(TEMPLATES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(self.templates, f, ensure_ascii=False, indent=2)
+        write_file_atomic(TEMPLATES_FILE, json_dumps(self.templates))
+        self._templates_mtime = file_mtime(TEMPLATES_FILE)
         logger.info("テンプレートを保存しました")
     
+    def reload_if_changed(self):
+        """他のプロセス（--add など）でファイルが更新されていれば読み直す"""
+        mtime = file_mtime(TRACKING_PRODUCTS_FILE)
+        if mtime != self._products_mtime:
+            self._products_mtime = mtime
+            try:
+                self.products = self.read_products()
+                self._by_asin = {product["asin"]: product for product in self.products}
+                logger.info(f"{TRACKING_PRODUCTS_FILE}が更新されたため再読み込みしました")
+            except (FileNotFoundError, json.JSONDecodeError) as e:
+                # ファイルの削除や記述ミスで追跡商品を失わないよう、現在の商品リストを使い続ける
+                logger.error(f"{TRACKING_PRODUCTS_FILE}を読み込めないため、現在の商品リストを使用します: {e}")
+        
+        mtime = file_mtime(TEMPLATES_FILE)
+        if mtime != self._templates_mtime:
+            self._templates_mtime = mtime
+            try:
+                self.templates = self.load_templates()
+                logger.info(f"{TEMPLATES_FILE}が更新されたため再読み込みしました")
+            except json.JSONDecodeError as e:
+                # 編集途中や記述ミスのファイルでチェックを止めないよう、現在のテンプレートを使い続ける
+                logger.error(f"{TEMPLATES_FILE}の解析に失敗したため、現在のテンプレートを使用します: {e}")
+    
     def add_template(self, name, template_data):
         """新しいテンプレートを追加"""
         self.templates[name] = template_data
@@ -124,13 +393,12 @@ class AmazonTracker:
         logger.info(f"新しいテンプレート「{name}」を追加しました")
 
     def sign_request(self, host, path, payload):
-        """PA-APIリクエストに署名を生成"""
-        # リクエスト日時
-        amz_date = datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
-        datestamp = datetime.utcnow().strftime('%Y%m%d')
+        """PA-APIリクエストに署名を生成（payloadは送信するバイト列）"""
+        # リクエスト日時（日付部分は同じ時刻から切り出す）
+        amz_date = amz_date_now()
+        datestamp = amz_date[:8]
         
         # 署名に必要な値
-        service = 'ProductAdvertisingAPI'
         algorithm = 'AWS4-HMAC-SHA256'
         canonical_uri = path
         canonical_querystring = ''
@@ -141,15 +409,15 @@ class AmazonTracker:
             'x-amz-date': amz_date,
             'content-encoding': 'amz-1.0',
             'content-type': 'application/json; charset=utf-8',
-            'x-amz-target': 'com.amazon.paapi5.v1.ProductAdvertisingAPIv1.GetItems'
+            'x-amz-target': PA_API_TARGET
         }
         
-        # カノニカルリクエストの作成
-        canonical_headers = '\n'.join([f"{k}:{v}" for k, v in sorted(headers.items())]) + '\n'
-        signed_headers = ';'.join(sorted(headers.keys()))
+        # カノニカルリクエストの作成（固定部分は事前に組み立て済み）
+        canonical_headers = CANONICAL_HEADERS_TEMPLATE.format(host=host, amz_date=amz_date)
+        signed_headers = SIGNED_HEADERS
         
         # ペイロードのSHA256ハッシュ
-        payload_hash = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        payload_hash = hashlib.sha256(payload).hexdigest()
         
         # カノニカルリクエスト
         canonical_request = '\n'.join([
@@ -162,7 +430,7 @@ class AmazonTracker:
         ])
         
         # 署名の作成
-        credential_scope = f"{datestamp}/{REGION}/{service}/aws4_request"
+        credential_scope = f"{datestamp}/{REGION}/{PA_API_SERVICE}/aws4_request"
         string_to_sign = '\n'.join([
             algorithm,
             amz_date,
@@ -170,17 +438,18 @@ class AmazonTracker:
             hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()
         ])
         
-        # 署名キーの生成
-        def sign(key, msg):
-            return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
-        
-        signing_key = sign(('AWS4' + PA_API_SECRET).encode('utf-8'), datestamp)
-        signing_key = sign(signing_key, REGION)
-        signing_key = sign(signing_key, service)
-        signing_key = sign(signing_key, 'aws4_request')
+        # 署名キーの生成（同じ日付の間はキャッシュを再利用）
+        signing_key = self._signing_key_cache.get(datestamp)
+        if signing_key is None:
+            signing_key = hmac.digest(('AWS4' + PA_API_SECRET).encode('utf-8'), datestamp.encode('utf-8'), 'sha256')
+            for msg in SIGNING_KEY_SCOPE:
+                signing_key = hmac.digest(signing_key, msg, 'sha256')
+            
+            # 古い日付のキーは不要なので、当日分だけを保持
+            self._signing_key_cache = {datestamp: signing_key}
         
         # 署名の計算
-        signature = hmac.new(signing_key, string_to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        signature = hmac.digest(signing_key, string_to_sign.encode('utf-8'), 'sha256').hex()
         
         # 認証ヘッダーの生成
         auth_header = (
@@ -201,70 +470,78 @@ class AmazonTracker:
         path = "/paapi5/getitems"
         url = f"https://{host}{path}"
         
-        # リクエストペイロード
-        payload = {
-            "ItemIds": asin_list,
-            "Resources": [
-                "ItemInfo.Title",
-                "Offers.Listings.Price",
-                "Offers.Listings.Availability.Message",
-                "Offers.Listings.DeliveryInfo.IsAmazonFulfilled"
-            ],
-            "PartnerTag": PARTNER_TAG,
-            "PartnerType": "Associates",
-            "Marketplace": "www.amazon.co.jp"
-        }
-        
-        payload_json = json.dumps(payload)
-        headers = self.sign_request(host, path, payload_json)
+        # リクエストペイロード（ASIN以外は固定値）
+        payload_bytes = json_dumps({"ItemIds": asin_list, **PA_API_PAYLOAD_TEMPLATE}, indent=False)
         
-        try:
-            response = requests.post(url, headers=headers, data=payload_json)
+        for attempt in range(PA_API_MAX_RETRIES + 1):
+            # API呼び出し制限を考慮して待機
+            self.pa_api_limiter.acquire()
+            headers = self.sign_request(host, path, payload_bytes)
+            
+            try:
+                response = self.http.post(url, headers=headers, data=payload_bytes, timeout=PA_API_TIMEOUT)
+            except Exception as e:
+                logger.error(f"PA-API 呼び出しエラー: {e}")
+                return None
+            
+            # スロットリングされた場合はペースを落とし、Retry-Afterに従って再試行
+            if response.status_code in (429, 503) and attempt < PA_API_MAX_RETRIES:
+                self.adjust_pa_api_rate(throttled=True)
+                wait = max(parse_retry_after(response), 1 / self.pa_api_limiter.rate)
+                logger.warning(f"PA-API スロットリング: {response.status_code} - {wait:.1f}秒後に再試行します")
+                time.sleep(wait)
+                continue
+            
             if response.status_code != 200:
                 logger.error(f"PA-API エラー: {response.status_code} - {response.text}")
                 return None
             
-            return response.json()
-            
-        except Exception as e:
-            logger.error(f"PA-API 呼び出しエラー: {e}")
-            return None
+            self.adjust_pa_api_rate(throttled=False)
+            try:
+                return response.json()
+            except ValueError as e:
+                logger.error(f"PA-API レスポンスの解析エラー: {e}")
+                return None
+    
+    def adjust_pa_api_rate(self, throttled):
+        """AIMD方式でPA-APIの発行ペースを調整（成功時は少しずつ戻し、スロットリング時は半減）"""
+        rate = self.pa_api_limiter.rate
+        if throttled:
+            new_rate = max(rate / 2, PA_API_MIN_TPS)
+        else:
+            new_rate = min(rate + PA_API_TPS_STEP, PA_API_TPS)
+        if new_rate != rate:
+            self.pa_api_limiter.set_rate(new_rate)
     
     def parse_pa_api_response(self, response):
         """PA-APIレスポンスから商品情報を抽出"""
         result = {}
         
-        if not response or "ItemsResult" not in response or "Items" not in response["ItemsResult"]:
+        if not response:
             return result
+        items = response.get("ItemsResult", {}).get("Items", [])
         
-        for item in response["ItemsResult"]["Items"]:
+        for item in items:
             asin = item.get("ASIN")
             if not asin:
                 continue
             
             # 商品タイトル
-            title = "不明"
-            if "ItemInfo" in item and "Title" in item["ItemInfo"] and "DisplayValue" in item["ItemInfo"]["Title"]:
-                title = item["ItemInfo"]["Title"]["DisplayValue"]
+            title = item.get("ItemInfo", {}).get("Title", {}).get("DisplayValue", "不明")
+            
+            # 出品情報（先頭のリスティングを使用）
+            listings = item.get("Offers", {}).get("Listings")
+            listing = listings[0] if listings else {}
             
             # 価格
-            price = None
-            if "Offers" in item and "Listings" in item["Offers"] and len(item["Offers"]["Listings"]) > 0:
-                listing = item["Offers"]["Listings"][0]
-                if "Price" in listing and "Amount" in listing["Price"]:
-                    price = int(float(listing["Price"]["Amount"]))
+            price_obj = listing.get("Price", {})
+            price = int(float(price_obj["Amount"])) if "Amount" in price_obj else None
             
             # 在庫状況
-            availability = "不明"
-            if "Offers" in item and "Listings" in item["Offers"] and len(item["Offers"]["Listings"]) > 0:
-                listing = item["Offers"]["Listings"][0]
-                if "Availability" in listing and "Message" in listing["Availability"]:
-                    availability = listing["Availability"]["Message"]
+            availability = listing.get("Availability", {}).get("Message", "不明")
             
             # 商品詳細URL
-            detail_url = f"https://www.amazon.co.jp/dp/{asin}?tag={PARTNER_TAG}"
-            if "DetailPageURL" in item:
-                detail_url = item["DetailPageURL"]
+            detail_url = item.get("DetailPageURL") or f"https://www.amazon.co.jp/dp/{asin}?tag={PARTNER_TAG}"
             
             result[asin] = {
                 "title": title,
@@ -277,6 +554,10 @@ class AmazonTracker:
     
     def add_product(self, asin):
         """商品を追跡リストに追加（アフィリエイトリンク対応）"""
+        if asin in self._by_asin:
+            logger.info(f"既に追跡中の商品です: {asin}")
+            return False
+        
         # PA-APIで商品情報を取得
         api_response = self.call_pa_api([asin])
         if not api_response:
@@ -298,6 +579,8 @@ class AmazonTracker:
             url_separator = "&" if "?" in url else "?"
             url = f"{url}{url_separator}tag={PARTNER_TAG}"
         
+        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
         # 商品情報を構築
         product = {
             "asin": asin,
@@ -305,55 +588,76 @@ class AmazonTracker:
             "url": url,
             "last_price": item_info.get("price"),
             "last_availability": item_info.get("availability"),
-            "last_checked": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "price_history": [
-                {
-                    "price": item_info.get("price"),
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-            ]
+            "last_checked": now_str
         }
         
         # 既存の商品リストに追加
         self.products.append(product)
+        self._by_asin[asin] = product
         self.save_products()
+        self.append_price_history([{
+            "asin": asin,
+            "price": item_info.get("price"),
+            "timestamp": now_str
+        }])
         logger.info(f"新商品を追加しました: {product['name']} ({asin})")
         return True
     
+    def fetch_product_info(self, asin_list):
+        """ASINリスト（最大10件）の商品情報を取得"""
+        api_response = self.call_pa_api(asin_list)
+        if not api_response:
+            logger.error(f"PA-API呼び出しに失敗しました: {', '.join(asin_list)}")
+            return {}
+        
+        product_info = self.parse_pa_api_response(api_response)
+        if not product_info:
+            logger.error(f"商品情報の取得に失敗: {', '.join(asin_list)}")
+            return {}
+        
+        return product_info
+    
     def check_products(self):
         """全ての追跡商品の情報を更新"""
+        # 再チェック判定の基準時刻（ファイルの再読み込みなどの処理時間に左右されないよう最初に取得）
+        cycle_start = time.monotonic()
+        self.reload_if_changed()
+        
         if not self.products:
             logger.info("追跡商品がありません")
             return
         
-        # ASINリストを作成（PA-APIは一度に10アイテムまで）
-        asin_chunks = [
-            [product["asin"] for product in self.products[i:i+10]]
-            for i in range(0, len(self.products), 10)
+        # 1回のチェックは同一時刻の計測として扱う
+        now_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        
+        # 再チェック時刻に達した商品のみを対象にする（価格が安定している商品のAPI呼び出しを削減）
+        # 実行間隔と再チェック間隔が同じ場合に実行時刻のわずかなずれで1回分飛ばさないよう、
+        # スケジューラの分解能分の余裕を持たせて判定する
+        asins = [
+            asin for asin in self._by_asin
+            if cycle_start + SCHEDULING_RESOLUTION >= self._next_check.get(asin, 0)
         ]
+        if not asins:
+            logger.info("再チェック時刻に達した商品がありません")
+            return
+        
+        # ASINリストを作成（PA-APIは一度に10アイテムまで）
+        asin_chunks = [asins[i:i+10] for i in range(0, len(asins), 10)]
         
         updated_products = {}
         
-        # チャンク単位で情報取得
-        for asin_list in asin_chunks:
-            # API呼び出し制限を考慮して待機
-            time.sleep(1)
-            
-            api_response = self.call_pa_api(asin_list)
-            if not api_response:
-                logger.error(f"PA-API呼び出しに失敗しました: {', '.join(asin_list)}")
-                continue
-            
-            product_info = self.parse_pa_api_response(api_response)
-            if not product_info:
-                logger.error(f"商品情報の取得に失敗: {', '.join(asin_list)}")
-                continue
-            
-            updated_products.update(product_info)
+        # チャンク単位で並行して情報取得（発行ペースはトークンバケットで制御）
+        max_workers = min(PA_API_MAX_WORKERS, len(asin_chunks))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for product_info in executor.map(self.fetch_product_info, asin_chunks):
+                updated_products.update(product_info)
+        
+        price_history = []
+        dirty = False
         
         # 変動を検出して通知
-        for product in self.products:
-            asin = product["asin"]
+        for asin in asins:
+            product = self._by_asin[asin]
             
             if asin not in updated_products:
                 logger.warning(f"商品情報が取得できませんでした: {asin}")
@@ -365,27 +669,40 @@ class AmazonTracker:
             last_price = product["last_price"]
             last_availability = product["last_availability"]
             
+            # 価格・在庫ともに前回と同じなら変動判定を省略
+            if current_price == last_price and current_availability == last_availability:
+                logger.info(f"変動なし: {product['name']}")
+                self._next_check[asin] = cycle_start + STABLE_PRODUCT_RECHECK_SECONDS
+                continue
+            
             changes = []
             
             # 価格変動の検知
             if current_price is not None and last_price is not None and current_price != last_price:
                 diff = current_price - last_price
                 diff_percent = (diff / last_price) * 100 if last_price > 0 else 0
-                price_change = {
+                price_history.append({
+                    "asin": asin,
                     "price": current_price,
-                    "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }
-                product["price_history"].append(price_change)
+                    "timestamp": now_str
+                })
                 
                 change_text = f"⬆️ {abs(diff):,}円上昇" if diff > 0 else f"⬇️ {abs(diff):,}円下落"
-                percent_text = f"({abs(diff_percent):.1f}%)"
                 
-                changes.append(f"価格変動: {change_text} {percent_text}")
+                changes.append({
+                    "type": "price_up" if diff > 0 else "price_down",
+                    "diff": abs(diff),
+                    "percent": abs(diff_percent)
+                })
                 logger.info(f"価格変動検知: {product['name']} - {last_price:,}円 → {current_price:,}円 ({change_text})")
             
             # 在庫状況変動の検知
             if current_availability is not None and last_availability is not None and current_availability != last_availability:
-                changes.append(f"在庫状況: {last_availability} → {current_availability}")
+                changes.append({
+                    "type": "availability_change",
+                    "old": last_availability,
+                    "new": current_availability
+                })
                 logger.info(f"在庫変動検知: {product['name']} - {last_availability} → {current_availability}")
             
             # 変動があれば投稿
@@ -393,17 +710,28 @@ class AmazonTracker:
                 # 商品情報を更新
                 product["last_price"] = current_price
                 product["last_availability"] = current_availability
-                product["last_checked"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                product["last_checked"] = now_str
+                dirty = True
                 
-                # X投稿
                 self.post_to_twitter(product, changes)
+                
+                # 変動のあった商品は次回も必ずチェック
+                self._next_check.pop(asin, None)
             else:
-                logger.info(f"変動なし: {product['name']}")
+                # 価格・在庫が取得できず前回と比較できなかった場合（次回も再チェック）
+                logger.info(f"比較できる変動がありません: {product['name']}")
         
-        # 変更を保存
-        self.save_products()
+        # 変更があった場合のみ保存
+        if dirty:
+            self.save_products()
+        self.append_price_history(price_history)
     
     def post_to_twitter(self, product, changes):
+        """X投稿をキューに追加（投稿はバックグラウンドのワーカーで実行）"""
+        # 投稿までに商品情報が更新されても影響しないようコピーを渡す
+        self._tweet_queue.put((dict(product), changes))
+    
+    def send_tweet(self, product, changes):
         """Xに投稿（テンプレート対応・アフィリエイトリンク付き）"""
         if not self.twitter_api:
             logger.error("Twitter API未設定のため投稿できません")
@@ -425,79 +753,75 @@ class AmazonTracker:
             template_name = "default"
             
             # 価格変動が10%以上の値下げの場合はフラッシュセールテンプレートを使用
-            if any("価格変動" in change for change in changes):
-                for change in changes:
-                    if "価格変動" in change and "下落" in change:
-                        # 価格変動の割合を抽出
-                        match = re.search(r'\((\d+\.\d+)%\)', change)
-                        if match and float(match.group(1)) >= 10.0:
-                            template_name = "flash_sale"
-                            break
+            if any(change["type"] == "price_down" and change["percent"] >= 10.0 for change in changes):
+                template_name = "flash_sale"
             
             template = self.templates.get(template_name, self.templates["default"])
             
-            # 投稿文を作成
-            post = f"{template['title']}\n{name}\n\n"
+            # 投稿文を作成（行単位で組み立てて最後に連結）
+            parts = [template['title'], name, ""]
             
+            # 変動の種類（price_up / price_down / availability_change）に対応するテンプレートで整形
             for change in changes:
-                if "価格変動" in change:
-                    if "上昇" in change:
-                        # 価格上昇の場合
-                        diff_match = re.search(r'(\d+,?\d*)円上昇', change)
-                        percent_match = re.search(r'\((\d+\.\d+)%\)', change)
-                        
-                        if diff_match and percent_match:
-                            diff = int(diff_match.group(1).replace(',', ''))
-                            percent = float(percent_match.group(1))
-                            post += f"・{template['price_up'].format(diff=diff, percent=percent)}\n"
-                    elif "下落" in change:
-                        # 価格下落の場合
-                        diff_match = re.search(r'(\d+,?\d*)円下落', change)
-                        percent_match = re.search(r'\((\d+\.\d+)%\)', change)
-                        
-                        if diff_match and percent_match:
-                            diff = int(diff_match.group(1).replace(',', ''))
-                            percent = float(percent_match.group(1))
-                            post += f"・{template['price_down'].format(diff=diff, percent=percent)}\n"
-                elif "在庫状況" in change:
-                    # 在庫状況変化の場合
-                    status_match = re.search(r'在庫状況: (.*) → (.*)', change)
-                    if status_match:
-                        old_status = status_match.group(1)
-                        new_status = status_match.group(2)
-                        post += f"・{template['availability_change'].format(old=old_status, new=new_status)}\n"
-                else:
-                    # その他の変化はそのまま追加
-                    post += f"・{change}\n"
+                parts.append(f"・{template[change['type']].format(**change)}")
             
             if current_price:
-                post += f"\n{template['current_price'].format(price=current_price)}\n"
+                parts += ["", template['current_price'].format(price=current_price)]
             
             # フッターがあれば追加
             if template.get('footer'):
-                post += f"\n{template['footer']}\n"
-                
-            post += f"\n{url}"
+                parts += ["", template['footer']]
+            
+            parts += ["", url]
             
-            # 投稿文が280文字を超える場合は調整
-            if len(post) > 280:
-                # 商品名を短縮
-                name_limit = max(10, len(name) - (len(post) - 270))
-                short_name = name[:name_limit] + "..."
-                post = post.replace(name, short_name)
+            # 投稿文が280文字（Xの重み付き文字数）を超える場合は連結前に商品名を短縮
+            # （アフィリエイトURLは切り詰めない）
+            overflow = sum(map(tweet_length, parts)) + len(parts) - 1 - TWEET_MAX_LENGTH
+            if overflow > 0:
+                name_length = tweet_length(name)
+                short_name = truncate_tweet_text(name, name_length - overflow - 3)
+                if len(short_name) < 10:
+                    short_name = name[:10]
+                # 「...」を付けても元の商品名より短くなる場合のみ置き換える
+                if tweet_length(short_name) + 3 < name_length:
+                    parts[1] = short_name + "..."
+            post = "\n".join(parts)
             
-            # それでも長い場合はさらに調整
-            if len(post) > 280:
-                post = post[:277] + "..."
+            # それでも長い場合はURLより前の本文を切り詰める
+            if tweet_length(post) > TWEET_MAX_LENGTH:
+                url_suffix = f"\n\n{url}"
+                body = post[:-len(url_suffix)]
+                limit = TWEET_MAX_LENGTH - tweet_length(url_suffix) - 3
+                post = truncate_tweet_text(body, limit) + "..." + url_suffix
             
             # 投稿
-            self.twitter_api.update_status(post)
+            self.twitter_api.create_tweet(text=post)
             logger.info(f"Xに投稿しました: {post[:50]}...")
             
         except Exception as e:
             logger.error(f"X投稿エラー: {e}")
 
 
+def check_worker(tracker, check_queue):
+    """チェック要求を受け取って商品チェックを実行するワーカー"""
+    while True:
+        check_queue.get()
+        try:
+            tracker.check_products()
+        except Exception as e:
+            logger.error(f"商品チェック中にエラーが発生しました: {e}")
+        finally:
+            check_queue.task_done()
+
+
+def request_check(check_queue):
+    """チェック要求をキューに追加（実行待ちの要求がある場合は追加しない）"""
+    try:
+        check_queue.put_nowait("check")
+    except queue.Full:
+        logger.warning("前回のチェック要求が処理されていないため、今回の要求をスキップします")
+
+
 def main():
     tracker = AmazonTracker()
     
@@ -514,6 +838,7 @@ def main():
         tracker.add_product(args.add)
     elif args.check:
         tracker.check_products()
+        tracker.wait_for_tweets()
     elif args.add_template:
         template_name = args.add_template[0]
         template_file = args.add_template[1]
@@ -526,14 +851,30 @@ def main():
             logger.error(f"テンプレートの追加に失敗しました: {e}")
     else:
         # 定期実行のスケジュール設定
-        schedule.every(args.interval).minutes.do(tracker.check_products)
+        # スケジューラはチェック要求をキューに積むだけにし、実際のチェックはワーカースレッドで実行
+        check_queue = queue.Queue(maxsize=1)
+        threading.Thread(target=check_worker, args=(tracker, check_queue), daemon=True).start()
+        schedule.every(args.interval).minutes.do(request_check, check_queue)
         logger.info(f"定期監視を開始しました。{args.interval}分ごとに実行されます。")
         
         try:
             while True:
+                # 次回実行までの時間だけ待機（時計の変化に備えて定期的に再計算）
+                idle_seconds = schedule.idle_seconds()
+                if idle_seconds is None:
+                    break
+                if idle_seconds > 0:
+                    time.sleep(min(idle_seconds, SCHEDULING_RESOLUTION))
                 schedule.run_pending()
-                time.sleep(60)
         except KeyboardInterrupt:
+            # 変動は保存済みのため、キューに残った投稿を捨てると次回以降も通知されない。
+            # 実行中のチェックとX投稿が完了するまで待ってから終了する（再度Ctrl-Cで即時終了）
+            logger.info("実行中のチェックと未送信のX投稿を処理してから終了します。")
+            try:
+                check_queue.join()
+                tracker.wait_for_tweets()
+            except KeyboardInterrupt:
+                logger.warning("未送信のX投稿を破棄して終了します。")
             logger.info("プログラムを終了します。")
 
 if __name__ == "__main__":